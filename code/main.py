@@ -132,6 +132,24 @@ parser.add_argument(
 parser.add_argument(
     "--use-resnet18", action="store_true", help="Use pretrained resnet18 model"
 )
+parser.add_argument(
+    "--compile-attack",
+    action="store_true",
+    help="Compile the PGD attack steps with torch.compile",
+)
+parser.add_argument(
+    "--channels-last", action="store_true", help="Use channels last (NHWC) memory format"
+)
+parser.add_argument(
+    "--allow-tf32",
+    action="store_true",
+    help="Enable TF32 for CUDA matmuls (incl. custom conv GEMMs) on Ampere+ GPUs",
+)
+parser.add_argument(
+    "--compile",
+    action="store_true",
+    help="Compile the model with torch.compile (CUDA graphs on GPU)",
+)
 parser.add_argument("--gpu", default=0, type=int, help="GPU ID to use.")
 
 
@@ -172,6 +190,17 @@ def main(args):
     if args.gpu >= 0:
         model = model.cuda(args.gpu)
         criterion = criterion.cuda(args.gpu)
+    if args.channels_last:
+        # NHWC lets cuDNN/oneDNN pick their channels last conv kernels
+        model = model.to(memory_format=torch.channels_last)
+    # TF32 trades matmul precision for tensor core throughput (cuDNN convs
+    # already use TF32 by default)
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+    # compiles the forward in place, so state_dict keys (and checkpoints) are unchanged
+    # reduce-overhead replays the many small conv launches as one CUDA graph
+    if args.compile:
+        model.compile(mode="reduce-overhead")
 
     # setup the optimizer
     if not args.use_vit:
@@ -275,6 +304,10 @@ def main(args):
     if args.resume and args.evaluate:
         print("Testing the model ...")
         cudnn.deterministic = True
+        # fold BatchNorm into the convs where the model supports it
+        if hasattr(model, "fuse"):
+            model.eval()
+            model.fuse()
         validate(val_loader, model, -1, args, writer, visualizer=visualizer)
         return
 
@@ -288,7 +321,7 @@ def main(args):
             -1,
             args,
             writer,
-            attacker=default_attack(criterion),
+            attacker=default_attack(criterion, use_compile=args.compile_attack),
             visualizer=visualizer,
         )
         return
@@ -381,6 +414,8 @@ def train(train_loader, model, criterion, optimizer, scheduler, epoch, args, wri
         if args.gpu >= 0:
             input = input.cuda(args.gpu, non_blocking=True)
             target = target.cuda(args.gpu, non_blocking=True)
+        if args.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
 
         # compute output
         output = model(input)
@@ -464,6 +499,8 @@ def validate(val_loader, model, epoch, args, writer, attacker=None, visualizer=N
             if args.gpu >= 0:
                 input = input.cuda(args.gpu, non_blocking=False)
                 target = target.cuda(args.gpu, non_blocking=False)
+            if args.channels_last:
+                input = input.contiguous(memory_format=torch.channels_last)
 
             # generate adversarial samples
             if attacker is not None:
@@ -477,6 +514,10 @@ def validate(val_loader, model, epoch, args, writer, attacker=None, visualizer=N
 
             # test time augmentation (minor performance boost)
             if args.evaluate:
+                # with --compile (CUDA graphs) the next call reuses the memory
+                # of the previous output, so keep a copy of it
+                if args.compile:
+                    output = output.clone()
                 flipped_input = torch.flip(input, (3,))
                 flipped_output = model(flipped_input)
                 output = 0.5 * (output + flipped_output)
@@ -1,10 +1,12 @@
+import copy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
 from torch.nn.modules.module import Module
-from torch.nn.functional import fold, unfold
+from torch.nn.functional import fold
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision.utils import make_grid
 import math
 
@@ -21,9 +23,40 @@ from custom_blocks import PatchEmbed, TransformerBlock, trunc_normal_
 #################################################################################
 # Part I: Understanding Convolutions
 #################################################################################
+def conv_output_size(input_size, kernel_size, stride, padding):
+    """
+    Spatial size (H_o, W_o) of a square-kernel convolution over an (H, W) input
+    """
+    H, W = input_size
+    return (
+        (H + 2 * padding - kernel_size) // stride + 1,
+        (W + 2 * padding - kernel_size) // stride + 1,
+    )
+
+
+def _is_channels_last(input_feats):
+    # NHWC but not also NCHW contiguous (as happens with a single channel or pixel)
+    return input_feats.is_contiguous(memory_format=torch.channels_last) and not input_feats.is_contiguous()
+
+
+def _im2col(input_feats, kernel_size, padding, stride):
+    """
+    Same result as unfold(input_feats, kernel_size, padding=padding, stride=stride)
+
+    Tensor.unfold gives a strided view of the patches (N, C_i, H_o, W_o, K, K)
+    without touching memory, so the only copy is the final reshape into
+    (N, C_i * K * K, H_o * W_o). Zero-padding, if any, is a cheap input-sized copy.
+    """
+    N, C_i = input_feats.size(0), input_feats.size(1)
+    if padding > 0:
+        input_feats = F.pad(input_feats, (padding, padding, padding, padding))
+    patches = input_feats.unfold(2, kernel_size, stride).unfold(3, kernel_size, stride)
+    return patches.permute(0, 1, 4, 5, 2, 3).reshape(N, C_i * kernel_size * kernel_size, -1)
+
+
 class CustomConv2DFunction(Function):
     @staticmethod
-    def forward(ctx, input_feats, weight, bias, stride=1, padding=0):
+    def forward(ctx, input_feats, weight, bias, stride=1, padding=0, output_size=None):
         """
         Forward propagation of convolution operation.
         We only consider square filters with equal stride/padding in width and height!
@@ -31,62 +64,111 @@ class CustomConv2DFunction(Function):
         Args:
           input_feats: input feature map of size N * C_i * H * W
           weight: filter weight of size C_o * C_i * K * K
+                  (or already flattened to C_o * (C_i * K * K))
           bias: (optional) filter bias of size C_o
           stride: (int, optional) stride for the convolution. Default: 1
           padding: (int, optional) Zero-padding added to both sides of the input. Default: 0
+          output_size: (tuple, optional) precomputed (H_o, W_o) of the output. Default: None
 
         Outputs:
           output: responses of the convolution  w*x+b
 
         """
+        # Extract necessary dimensions
+        N, C_i, H, W = input_feats.shape
+        C_o = weight.size(0)
+
         # sanity check
-        assert weight.size(2) == weight.size(3)
-        assert input_feats.size(1) == weight.size(1)
+        if weight.dim() == 4:
+            assert weight.size(2) == weight.size(3)
+            assert C_i == weight.size(1)
+            kernel_size = weight.size(2)
+        else:
+            # a flattened weight carries K only through its row length C_i * K * K
+            kernel_size = math.isqrt(weight.size(1) // C_i)
+            assert C_i * kernel_size * kernel_size == weight.size(1)
         assert isinstance(stride, int) and (stride > 0)
         assert isinstance(padding, int) and (padding >= 0)
 
         # save the conv params
-        kernel_size = weight.size(2)
+        ctx.kernel_size = kernel_size
         ctx.stride = stride
         ctx.padding = padding
-        ctx.input_height = input_feats.size(2)
-        ctx.input_width = input_feats.size(3)
+        ctx.input_size = (H, W)
 
         # make sure this is a valid convolution
-        assert kernel_size <= (input_feats.size(2) + 2 * padding)
-        assert kernel_size <= (input_feats.size(3) + 2 * padding)
+        assert kernel_size <= (H + 2 * padding)
+        assert kernel_size <= (W + 2 * padding)
 
         #################################################################################
         # Fill in the code here
         #################################################################################
 
-        # Extract necessary dimensions
-        N, H = input_feats.size(0), input_feats.size(2)
-        C_o = weight.size(0)
+        # unfold and the GEMMs below assume NCHW. Hand channels last (NHWC) inputs
+        # to the native conv, which has NHWC kernels; backward is unchanged
+        if _is_channels_last(input_feats):
+            ctx.pointwise = False
+            if weight.dim() == 4:
+                weight_4d = weight
+            else:
+                weight_4d = weight.reshape(C_o, C_i, kernel_size, kernel_size)
+            output = F.conv2d(input_feats, weight_4d, bias, stride, padding)
+            ctx.save_for_backward(input_feats, weight, bias)
+            return output
+
+        # 1x1 fast path: im2col is the identity here, so skip unfold altogether
+        # and treat the input as a (N, C_i, H * W) matrix
+        ctx.pointwise = kernel_size == 1 and padding == 0 and stride == 1
+        if ctx.pointwise:
+            # Write the GEMM straight into the (N, C_o, H, W) output: returning a view
+            # of an intermediate would break the in-place ReLUs that follow
+            output = input_feats.new_empty(N, C_o, H, W)
+            output_unfolded = output.view(N, C_o, H * W)
+            input_flat = input_feats.reshape(N, C_i, H * W)
+            weight_batched = weight.reshape(1, C_o, C_i).expand(N, -1, -1)
+            if bias is not None:
+                # bias add fused into the GEMM epilogue
+                bias_broadcast = bias.view(1, -1, 1).expand(N, C_o, H * W)
+                torch.baddbmm(bias_broadcast, weight_batched, input_flat, out=output_unfolded)
+            else:
+                torch.bmm(weight_batched, input_flat, out=output_unfolded)
+            ctx.save_for_backward(input_feats, weight, bias)
+            return output
 
         # input_unfolded.shape = (N, C_i * K * K, H_o * W_o)
         # unfold([[[[1, 2], [3, 4]], [[5, 6], [7, 8]]]]) = [[[[1, ..., 8]]]]
         # weight_unfolded.shape = (C_o, C_i * K * K)
-        input_unfolded = unfold(input_feats, kernel_size, padding=padding, stride=stride)
-        weight_unfolded = weight.view(C_o, -1)
+        input_unfolded = _im2col(input_feats, kernel_size, padding, stride)
+        weight_unfolded = weight.reshape(C_o, -1) if weight.dim() == 4 else weight
+
+        # Allocate the output in grid shape and let the GEMM write into its
+        # unfolded view. Returning a view of output_unfolded instead would trip
+        # the in-place modification check, and cloning it costs a full copy.
+        # output.shape = (N, C_o, H_o, W_o)
+        if output_size is None:
+            output_size = conv_output_size((H, W), kernel_size, stride, padding)
+        H_o, W_o = output_size
+        output = input_feats.new_empty(N, C_o, H_o, W_o)
 
         # output_unfolded.shape = (N, C_o, H_o * W_o)
-        output_unfolded = weight_unfolded @ input_unfolded
+        output_unfolded = output.view(N, C_o, H_o * W_o)
         # Broadcast bias along
         # - the output grid
         # - the input channels
         # Trivially, the batch dimension too but that's the case for all parameters
+        # and add it inside the GEMM (beta=1 accumulator) rather than in a second pass
+        # The weight is expanded along the batch (a stride trick, no copy) so both
+        # cases run as a single batched GEMM instead of a broadcasting matmul
+        weight_batched = weight_unfolded.unsqueeze(0).expand(N, -1, -1)
         if bias is not None:
-            output_unfolded += bias.view(-1, 1)
-        # Fold the output to grid shape
-        # output.shape = (N, C_o, H_o, W_o)
-        H_o = (H + 2 * padding - kernel_size) // stride + 1
-        # Use reshape instead of view to avoid in-place modification errors
-        output = output_unfolded.view(N, C_o, H_o, -1).clone()
+            bias_broadcast = bias.view(1, -1, 1).expand(N, C_o, H_o * W_o)
+            torch.baddbmm(bias_broadcast, weight_batched, input_unfolded, out=output_unfolded)
+        else:
+            torch.bmm(weight_batched, input_unfolded, out=output_unfolded)
 
-        # save for backward (you need to save the unfolded tensor into ctx)
-        # ctx.save_for_backward(your_vars, weight, bias)
-        ctx.save_for_backward(input_unfolded, weight, bias)
+        # save for backward. The unfolded tensor is K * K times larger than the
+        # input, so keep the input and redo the unfold in backward if needed
+        ctx.save_for_backward(input_feats, weight, bias)
 
         return output
 
@@ -105,16 +187,14 @@ class CustomConv2DFunction(Function):
 
         """
         # unpack tensors and initialize the grads
-        # your_vars, weight, bias = ctx.saved_tensors
-        input_unfolded, weight, bias = ctx.saved_tensors
+        input_feats, weight, bias = ctx.saved_tensors
         grad_input = grad_weight = grad_bias = None
 
         # recover the conv params
-        kernel_size = weight.size(2)
+        kernel_size = ctx.kernel_size
         stride = ctx.stride
         padding = ctx.padding
-        input_height = ctx.input_height
-        input_width = ctx.input_width
+        input_size = ctx.input_size
 
         #################################################################################
         # Fill in the code here
@@ -122,33 +202,57 @@ class CustomConv2DFunction(Function):
         # compute the gradients w.r.t. input and params
 
         # grad_output_unfolded.shape = (N, C_o, H_o * W_o)
-        grad_output_unfolded = grad_output.view(grad_output.size(0), grad_output.size(1), -1)
+        grad_output_unfolded = grad_output.reshape(grad_output.size(0), grad_output.size(1), -1)
+
+        # 1x1 fast path: no unfold/fold needed in either direction
+        if ctx.pointwise:
+            C_o, C_i = weight.size(0), input_feats.size(1)
+            weight_unfolded = weight.reshape(C_o, C_i)
+            if ctx.needs_input_grad[0]:
+                grad_input = torch.einsum("oc,nom->ncm", weight_unfolded, grad_output_unfolded)
+                grad_input = grad_input.view_as(input_feats)
+            if ctx.needs_input_grad[1]:
+                # Fold the batch into the contraction dim: (C_o, N * H * W) @ (N * H * W, C_i)
+                grad_output_flat = grad_output_unfolded.transpose(0, 1).reshape(C_o, -1)
+                input_flat = input_feats.transpose(0, 1).reshape(C_i, -1)
+                grad_weight = (grad_output_flat @ input_flat.t()).view_as(weight)
+            if bias is not None and ctx.needs_input_grad[2]:
+                grad_bias = grad_output.sum((0, 2, 3))
+            return grad_input, grad_weight, grad_bias, None, None, None
 
         # Compute input gradients
         if ctx.needs_input_grad[0]:
             # weight_unfolded.shape = (C_o, C_i * K * K)
             # grad_input_unfolded.shape = (N, C_i * K * K, H_o * W_o)
             # grad_input.shape = (N, C_i, H, W)
-            weight_unfolded = weight.view(weight.size(0), -1)
-            grad_input_unfolded = weight_unfolded.T @ grad_output_unfolded
-            grad_input = fold(grad_input_unfolded, (input_height, input_width), kernel_size, padding=padding, stride=stride)
+            weight_unfolded = weight.reshape(weight.size(0), -1) if weight.dim() == 4 else weight
+            grad_input_unfolded = torch.einsum("oc,nom->ncm", weight_unfolded, grad_output_unfolded)
+            grad_input = fold(grad_input_unfolded, input_size, kernel_size, padding=padding, stride=stride)
 
         # Compute weight gradients
         if ctx.needs_input_grad[1]:
-            # input_transpose.shape = (N, H_o * W_o, C_i * K * K)
+            # Recompute the unfolded input dropped in forward
+            # input_unfolded.shape = (N, C_i * K * K, H_o * W_o)
+            input_unfolded = _im2col(input_feats, kernel_size, padding, stride)
+            # grad_output_flat.shape = (C_o, N * H_o * W_o)
+            # input_flat.shape = (C_i * K * K, N * H_o * W_o)
             # grad_weight_unfolded.shape = (C_o, C_i * K * K)
-            # grad_weight.shape = (C_o, C_i, K, K)
-            input_transpose = torch.transpose(input_unfolded, 1, 2)
-            # Sum over the batch dimension. Additive contribution.
-            grad_weight_unfolded = torch.sum(grad_output_unfolded @ input_transpose, dim=0)
-            # Use reshape, not view, to avoid in-place errors
-            grad_weight = grad_weight_unfolded.view(weight.size(0), -1, kernel_size, kernel_size)
+            # grad_weight.shape = weight.shape
+            # Treat the batch and the output grid as one contraction dim, so a
+            # single GEMM does the sum over the batch with no per-sample products
+            C_o = weight.size(0)
+            grad_output_flat = grad_output_unfolded.transpose(0, 1).reshape(C_o, -1)
+            input_flat = input_unfolded.transpose(0, 1).reshape(input_unfolded.size(1), -1)
+            # input_flat.t() stays a transposed view: the GEMM takes the transpose as
+            # a flag, which beats copying it to a contiguous layout first
+            grad_weight_unfolded = grad_output_flat @ input_flat.t()
+            grad_weight = grad_weight_unfolded.view_as(weight)
 
         if bias is not None and ctx.needs_input_grad[2]:
             # compute the gradients w.r.t. bias (if any)
             grad_bias = grad_output.sum((0, 2, 3))
 
-        return grad_input, grad_weight, grad_bias, None, None
+        return grad_input, grad_weight, grad_bias, None, None, None
 
 
 custom_conv2d = CustomConv2DFunction.apply
@@ -184,6 +288,11 @@ class CustomConv2d(Module):
         self.dilation = dilation
         self.groups = groups
 
+        # the op takes the weight pre-flattened to (C_o, C_i * K * K)
+        self._weight_flat_shape = (out_channels, in_channels * kernel_size * kernel_size)
+        # (H, W) -> (H_o, W_o), filled in once per input resolution
+        self._output_sizes = {}
+
         # register weight and bias as parameters
         self.weight = nn.Parameter(
             torch.Tensor(out_channels, in_channels, kernel_size, kernel_size)
@@ -203,8 +312,28 @@ class CustomConv2d(Module):
             nn.init.uniform_(self.bias, -bound, bound)
 
     def forward(self, input):
+        # nothing to backprop through (e.g. validation under no_grad): the custom op
+        # computes the same result, so take the native kernel instead
+        if not torch.is_grad_enabled() or not (
+            input.requires_grad
+            or self.weight.requires_grad
+            or (self.bias is not None and self.bias.requires_grad)
+        ):
+            return F.conv2d(input, self.weight, self.bias, self.stride, self.padding)
+
         # call our custom conv2d op
-        return custom_conv2d(input, self.weight, self.bias, self.stride, self.padding)
+        # only the unfold/GEMM path wants the flat weight; NHWC inputs go to F.conv2d
+        # inside the op, so pass the (possibly channels last) 4D weight untouched
+        if _is_channels_last(input):
+            weight = self.weight
+        else:
+            weight = self.weight.reshape(self._weight_flat_shape)
+        input_size = input.shape[2:]
+        output_size = self._output_sizes.get(input_size)
+        if output_size is None:
+            output_size = conv_output_size(input_size, self.kernel_size, self.stride, self.padding)
+            self._output_sizes[input_size] = output_size
+        return custom_conv2d(input, weight, self.bias, self.stride, self.padding, output_size)
 
     def extra_repr(self):
         s = (
@@ -277,6 +406,38 @@ class SimpleNet(nn.Module):
         return x
     
 
+def _fold_bn_into_next(bn, layer):
+    """
+    Fold an eval-mode BatchNorm into the conv/linear layer that consumes its output.
+    BN is a per-channel affine map a * x + b, so layer(a * x + b) only needs the
+    input channels of the weight scaled by a and the bias shifted by weight * b.
+    For convs this only holds without zero-padding (padded zeros never see the shift).
+    """
+    assert not bn.training, "Fusion only for eval!"
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    fused = copy.deepcopy(layer)
+    weight = fused.weight.detach()
+    # broadcast along the input channel dim of the weight
+    shape = [1, -1] + [1] * (weight.dim() - 2)
+    bias = (weight * shift.view(shape)).flatten(1).sum(1)
+    if fused.bias is not None:
+        bias = bias + fused.bias.detach()
+    fused.weight = nn.Parameter(weight * scale.view(shape))
+    fused.bias = nn.Parameter(bias.detach())
+    return fused
+
+
+class ResidualBlock(nn.Sequential):
+    """
+    nn.Sequential with an identity shortcut around it. Keeping the sum inside the
+    module lets a compiled block capture it too.
+    """
+
+    def forward(self, x):
+        return super(ResidualBlock, self).forward(x) + x
+
+
 class CustomNet(nn.Module):
     # a simple CNN for image classifcation
     def __init__(self, conv_op=nn.Conv2d, num_classes=100, res_depth = 4):
@@ -307,23 +468,12 @@ class CustomNet(nn.Module):
             nn.BatchNorm2d(256),
         )
 
-        resblock = nn.Sequential(
-            # conv2 block: simple bottleneck
-            conv_op(256, 64, kernel_size=1, stride=1, padding=0),
-            nn.ReLU(inplace=True),
-            conv_op(64, 64, kernel_size=3, stride=1, padding=1),
-            nn.ReLU(inplace=True),
-            conv_op(64, 256, kernel_size=1, stride=1, padding=0),
-            nn.ReLU(inplace=True),
-
-            nn.BatchNorm2d(256),
-        )
-
         self.reslist = nn.ModuleList()
         self.res_depth = res_depth
 
+        # each residual block gets its own parameters
         for i in range(res_depth):
-            self.reslist.append(resblock)
+            self.reslist.append(self._make_resblock(conv_op))
 
 
         self.features2 = nn.Sequential(
@@ -355,16 +505,51 @@ class CustomNet(nn.Module):
                 nn.init.constant_(m.weight, 1.0)
                 nn.init.constant_(m.bias, 0.0)
 
+    @staticmethod
+    def _make_resblock(conv_op):
+        return ResidualBlock(
+            # conv2 block: simple bottleneck
+            conv_op(256, 64, kernel_size=1, stride=1, padding=0),
+            nn.ReLU(inplace=True),
+            conv_op(64, 64, kernel_size=3, stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            conv_op(64, 256, kernel_size=1, stride=1, padding=0),
+            nn.ReLU(inplace=True),
+
+            nn.BatchNorm2d(256),
+        )
+
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold the BatchNorm layers into neighbouring convs/linears for inference.
+        A BN right after a conv goes into that conv; a BN feeding an unpadded conv
+        or a linear goes into the next layer. Folded BNs become nn.Identity, so
+        this is one-way: only call it on a model that is done training.
+        """
+        assert not self.training, "Fusion only for eval!"
+        conv_types = (nn.Conv2d, CustomConv2d)
+        for seq in [self.features1, *self.reslist, self.features2]:
+            for i in range(len(seq) - 1):
+                cur, nxt = seq[i], seq[i + 1]
+                if isinstance(cur, conv_types) and isinstance(nxt, nn.BatchNorm2d):
+                    seq[i], seq[i + 1] = fuse_conv_bn_eval(cur, nxt), nn.Identity()
+                elif (isinstance(cur, nn.BatchNorm2d) and isinstance(nxt, conv_types)
+                      and nxt.padding in (0, (0, 0))):
+                    seq[i], seq[i + 1] = nn.Identity(), _fold_bn_into_next(cur, nxt)
+        # the head runs fc1 -> relu -> batchnorm -> fc2
+        self.fc2 = _fold_bn_into_next(self.batchnorm, self.fc2)
+        self.batchnorm = nn.Identity()
+        return self
+
     def forward(self, x):
         # you can implement adversarial training here
         # if self.training:
         #   # generate adversarial sample based on x
         x = self.features1(x)
 
-        for i in range(self.res_depth):
-            residuals = x
-            x = self.reslist[i](x)
-            x = x + residuals
+        for resblock in self.reslist:
+            x = resblock(x)
 
         x = self.features2(x)
         x = self.avgpool(x)
@@ -441,8 +626,12 @@ class SimpleViT(nn.Module):
         else:
             self.pos_embed = None
 
+        # interpolated position embeddings keyed by (h, w), see forward
+        self._pos_cache = {}
+        self._pos_cache_state = None
+
         # stochastic depth decay rule
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
+        dpr = torch.linspace(0, drop_path_rate, depth).tolist()
 
         ########################################################################
         # Fill in the code here
@@ -456,7 +645,8 @@ class SimpleViT(nn.Module):
         )
 
         # Define transformer layers that make up the transformer enconder
-        self.transformer_blocks = nn.ModuleList()
+        # The blocks only take x, so chain them in a Sequential
+        blocks = []
 
         for i in range(depth):
             tblock = TransformerBlock(
@@ -470,7 +660,9 @@ class SimpleViT(nn.Module):
                 window_size=window_size if i in window_block_indexes else 0,
             )
 
-            self.transformer_blocks.append(tblock)
+            blocks.append(tblock)
+
+        self.transformer_blocks = nn.Sequential(*blocks)
 
         # Define final head and normalization for logit outputs
         self.norm = nn.LayerNorm(embed_dim)
@@ -514,12 +706,25 @@ class SimpleViT(nn.Module):
 
             # Handle the case if h/w do not equal patches_per_side
             if patches_per_side != h or patches_per_side != w:
-                new_abs_pos = F.interpolate(
-                    abs_pos.reshape(1, patches_per_side, patches_per_side, -1).permute(0, 3, 1, 2),
-                    size=(h,w),
-                    mode="bicubic",
-                    align_corners=False,
-                )
+                # The resized embedding only depends on (h, w) and pos_embed, so it is
+                # cached when no gradient flows to pos_embed (e.g. eval / attacks).
+                # Any update to pos_embed (version bump or new storage) drops the cache.
+                use_cache = not (torch.is_grad_enabled() and abs_pos.requires_grad)
+                cache_state = (abs_pos._version, abs_pos.data_ptr())
+                if cache_state != self._pos_cache_state:
+                    self._pos_cache.clear()
+                    self._pos_cache_state = cache_state
+                new_abs_pos = self._pos_cache.get((h, w)) if use_cache else None
+
+                if new_abs_pos is None:
+                    new_abs_pos = F.interpolate(
+                        abs_pos.reshape(1, patches_per_side, patches_per_side, -1).permute(0, 3, 1, 2),
+                        size=(h,w),
+                        mode="bicubic",
+                        align_corners=False,
+                    )
+                    if use_cache:
+                        self._pos_cache[(h, w)] = new_abs_pos
 
                 abs_pos = new_abs_pos.permute(0, 2, 3, 1)
             else:
@@ -529,14 +734,12 @@ class SimpleViT(nn.Module):
             x = x + abs_pos
 
         # Apply transformation blocks
-        for tblock in self.transformer_blocks:
-            x = tblock(x)
+        x = self.transformer_blocks(x)
 
         # Apply final normalization/head
-        # Collapse the patches, reorder into (batch_size, embed_dim, #patches)
-        x = x.reshape(x.shape[0], -1, x.shape[-1]).permute(0, 2, 1)
-        # Aggregate the patch features by using global average
-        x = x.mean(2)
+        # Aggregate the patch features by using global average over the
+        # (batch_size, h, w, embed_dim) grid
+        x = x.mean(dim=(1, 2))
         # Apply normalization layer
         x = self.norm(x)
         # Apply head layer
@@ -581,8 +784,41 @@ def get_val_transforms(normalize):
 #################################################################################
 # Part III: Adversarial samples and Attention
 #################################################################################
+def _pgd_step(model, loss_fn, output, lower, upper, step_size):
+    """
+    One PGD step: move output against the gradient of the loss of the least
+    confident label, then project back into [lower, upper]
+    """
+    output = output.detach().requires_grad_()
+
+    # Forward pass
+    with torch.enable_grad():
+        logits = model(output)
+
+        pred = logits.argmin(dim=1)
+        loss = loss_fn(logits, pred)
+
+    # Get the gradients and store them externally from model
+    gradients, = torch.autograd.grad(loss, [output])
+
+    # Create adversarial sample, clamp values
+    output = output.detach() - step_size * torch.sign(gradients)
+    return torch.clamp(output, lower, upper)
+
+
+_compiled_pgd_step = None
+
+
+def _get_compiled_pgd_step():
+    # compiled on first use only; autograd.grad forces a graph break, so no fullgraph
+    global _compiled_pgd_step
+    if _compiled_pgd_step is None:
+        _compiled_pgd_step = torch.compile(_pgd_step)
+    return _compiled_pgd_step
+
+
 class PGDAttack(object):
-    def __init__(self, loss_fn, num_steps=10, step_size=0.01, epsilon=0.1):
+    def __init__(self, loss_fn, num_steps=10, step_size=0.01, epsilon=0.1, use_compile=False):
         """
         Attack a network by Project Gradient Descent. The attacker performs
         k steps of gradient descent of step size a, while always staying
@@ -594,11 +830,15 @@ class PGDAttack(object):
           step_size: (float) step size of PGD (i.e., alpha in our lecture)
           epsilon: (float) the range of acceptable samples
                    for our normalization, 0.1 ~ 6 pixel levels
+          use_compile: (bool) run each step through torch.compile. Only the
+                   sign/step/clamp tail gets fused, and every new batch size
+                   recompiles, so this is off by default
         """
         self.loss_fn = loss_fn
         self.num_steps = num_steps
         self.step_size = step_size
         self.epsilon = epsilon
+        self.use_compile = use_compile
 
     def perturb(self, model, input):
         """
@@ -624,25 +864,14 @@ class PGDAttack(object):
         if training:
             model.eval()
         
-        for i in range(self.num_steps):
-            output.requires_grad_() # require gradients
-            
-            if output.grad is not None:
-                output.grad.zero_() 
-
-            # Forward pass
-            with torch.enable_grad():
-                logits = model(output)
-
-                pred = logits.argmin(dim=1)
-                loss = self.loss_fn(logits, pred)
+        # the epsilon ball around the input is fixed, compute its bounds once
+        input = input.detach()
+        lower = input - self.epsilon
+        upper = input + self.epsilon
 
-            # Get the gradients and store them externally from model
-            gradients = torch.autograd.grad(loss, [output])[0]
-
-            # Create adversarial sample, clamp values
-            output = output.detach() - self.step_size * torch.sign(gradients.detach())
-            output = torch.max(torch.min(output.data, input + self.epsilon), input - self.epsilon)
+        pgd_step = _get_compiled_pgd_step() if self.use_compile else _pgd_step
+        for i in range(self.num_steps):
+            output = pgd_step(model, self.loss_fn, output, lower, upper, self.step_size)
 
         # Set model back to training if necessary
         if training:
@@ -684,9 +913,11 @@ class GradAttention(object):
         if input.grad is not None:
             input.grad.zero_()
 
+        # only input gradients are needed. Freeze on every call: parameters may
+        # have been unfrozen or replaced (e.g. by CustomNet.fuse) since the last one
         for params in model.parameters():
-            params.requires_grad = False
-        
+            params.requires_grad_(False)
+
         model.eval()
 
         # Forward pass
@@ -697,11 +928,10 @@ class GradAttention(object):
         # Backward pass
         loss.backward() 
 
-        grads = input.grad.data.abs()
-       
-        # Take maximum across channels
-        saliency, _ = grads.max(1)
-        saliency = saliency.unsqueeze(1)
+        grads = input.grad.abs()
+
+        # Take maximum across channels (amax skips building the unused argmax)
+        saliency = torch.amax(grads, dim=1, keepdim=True)
         return saliency
 
 
@@ -45,6 +45,11 @@ if err < atol:
 else:
     print("Fprop testing failed")
 
+# the output feeds in-place ops (e.g. ReLU(inplace=True)), so it must not be
+# a view created inside the custom Function
+custom_output = custom_conv2d(input_feats, weight, bias, stride, padding)
+torch.relu_(custom_output)
+
 # backward
 print("Check Bprop ...")
 inputs = (input_feats, weight, bias, stride, padding)
@@ -54,6 +59,21 @@ if test:
 else:
     print("Bprop testing failed")
 
+# 1x1 convs take a separate path that skips unfold/fold
+print("Check 1x1 fast path ...")
+pw_weight = torch.randn(
+    out_channels, in_channels, 1, 1, requires_grad=True, device=device
+).double()
+ref_output = ref_conv2d(input_feats, pw_weight, bias, 1, 0)
+custom_output = custom_conv2d(input_feats, pw_weight, bias, 1, 0)
+err = (custom_output - ref_output).abs().max()
+inputs = (input_feats, pw_weight, bias, 1, 0)
+test = gradcheck(custom_conv2d, inputs, eps=1e-4, atol=atol)
+if err < atol and test:
+    print("1x1 fast path testing passed")
+else:
+    print("1x1 fast path testing failed")
+
 print("Check nn.module wrapper ...")
 
 # instantiate custom conv2d module and test the wrapper